@@ -2,16 +2,28 @@
 # Imports necessary libraries
 # ---------------------------
 import os
-import re
+import argparse
+import json
+import shutil
+import base64
 import time
 import warnings
 import datetime
+import queue
+from collections import Counter
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import pandas as pd
 import img2pdf
-from PyPDF2 import PdfMerger
-from PIL import Image
+import pikepdf
 from selenium import webdriver
 from selenium.webdriver.chrome.options import Options
+from selenium.common.exceptions import (
+    InvalidSessionIdException,
+    NoSuchWindowException,
+    TimeoutException,
+    WebDriverException,
+)
 from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support import expected_conditions as EC
@@ -31,24 +43,86 @@ password = os.getenv('IMEDIDATA_PASSWORD')
 if not username or not password:
     raise ValueError("Environment variables IMEDIDATA_USERNAME and IMEDIDATA_PASSWORD must be set in credentials.env")
 
+# Translation table mapping characters not allowed in filenames to underscores
+INVALID_FILENAME_CHARS = str.maketrans({c: '_' for c in '<>:"/\\|?*'})
+
+# Number of Chrome instances capturing CRFs in parallel
+MAX_WORKERS = 3
+
+# Device scale factor used unless --high-fidelity is given
+FAST_SCALE_FACTOR = 0.75
+
+# JPEG quality for screenshots unless --lossless is given
+JPEG_QUALITY = 80
+
+# UI elements hidden from every capture
+HIDDEN_SELECTORS = ['.mcc-sidebar-left', '._pendo-image', '._pendo-badge', '.sticky-bottom']
+
+# Matches the CRF's form fields; prepare_page waits for one before capturing
+CRF_READY_SELECTOR = "form select, form textarea, form input:not([type='hidden'])"
+
+# Seconds to wait for CRF fields after the page has loaded. Pages without any
+# (read-only CRFs, permission or error pages) are captured once this runs out
+CRF_READY_TIMEOUT = 3
+
+# Name of the per-run index of captured PDFs, kept in the output directory
+INDEX_FILENAME = ".index.json"
+
+# ------------------------------------------------
+# Checks whether the browser is already logged in
+# ------------------------------------------------
+def has_active_session(driver):
+    """
+    Opens iMedidata and reports whether the saved session cookies are still valid,
+    i.e. the portal loads without redirecting to the login form.
+    """
+    driver.get("https://login.imedidata.com/")
+    try:
+        WebDriverWait(driver, 5).until(
+            lambda d: d.find_elements(By.NAME, "session[username]")
+            or (not urlparse(d.current_url).path.startswith("/login") and d.find_elements(By.ID, "root"))
+        )
+    except TimeoutException:
+        return False
+    return not driver.find_elements(By.NAME, "session[username]")
+
 # ----------------------------------
 # Authenticates the user in iMedidata
 # ----------------------------------
-def login(driver):
+def login(driver, interactive=True):
     """
     Logs into the iMedidata portal.
+    0. Returns right away if the Chrome profile already holds a valid session.
     1. Goes to the login page.
     2. Waits for the username/password fields, fills them with credentials.
     3. Handles potential 2FA (prompts user to continue manually).
     4. Waits until redirected to the main iMedidata page.
+    When interactive is False, only step 0 runs: credentials are never submitted,
+    so a 2FA challenge is only ever raised in the browser the user can see.
+    Returns True once logged in, or False if not interactive and no session exists.
     """
+    if has_active_session(driver):
+        print("Existing session found, skipping login.")
+        return True
+    if not interactive:
+        return False
+
     login_url = "https://login.imedidata.com/login"
     driver.get(login_url)
     try:
         WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.NAME, "session[username]")))
-        driver.find_element(By.NAME, "session[username]").send_keys(username)
-        driver.find_element(By.NAME, "session[password]").send_keys(password)
-        driver.find_element(By.CSS_SELECTOR, "button[data-testid='sign_in_button']").click()
+        # Fill both fields and submit in one round-trip; the native value setter plus
+        # an input event keeps the form's own state in sync with the typed values
+        driver.execute_script("""
+            const [user, pass] = arguments;
+            const setValue = Object.getOwnPropertyDescriptor(HTMLInputElement.prototype, 'value').set;
+            [['session[username]', user], ['session[password]', pass]].forEach(([name, value]) => {
+                const input = document.querySelector(`[name="${name}"]`);
+                setValue.call(input, value);
+                input.dispatchEvent(new Event('input', { bubbles: true }));
+            });
+            document.querySelector("button[data-testid='sign_in_button']").click();
+        """, username, password)
 
         # Wait briefly to check if 2FA is required
         time.sleep(5)
@@ -64,6 +138,7 @@ def login(driver):
     except Exception as e:
         print(f"Login error: {e}")
         input("Complete manual login and press Enter.")
+    return True
 
 # -------------------------------
 # Cleans up file names for saving
@@ -73,7 +148,33 @@ def sanitize_filename(name):
     Replaces invalid filename characters with underscores and strips whitespace.
     Returns the sanitized filename string.
     """
-    return re.sub(r'[<>:"/\\|?*]', '_', name).strip()
+    return name.translate(INVALID_FILENAME_CHARS).strip()
+
+# ------------------------------------------------
+# Makes CRF file names unique across the spreadsheet
+# ------------------------------------------------
+def make_unique_names(names):
+    """
+    Appends the spreadsheet row number to every name that occurs more than once,
+    so each row gets its own PDF file and bookmark (row 1 is the header).
+    Names are compared case-insensitively, as Windows file names are; if a
+    suffixed name still clashes with another name, a counter is added as well.
+    Returns the list of unique names.
+    """
+    counts = Counter(name.casefold() for name in names)
+    used = set()
+    unique_names = []
+    for i, name in enumerate(names):
+        unique_name = name
+        if counts[name.casefold()] > 1:
+            unique_name = f"{name} (row {i + 2})"
+            n = 2
+            while unique_name.casefold() in counts or unique_name.casefold() in used:
+                unique_name = f"{name} (row {i + 2}, {n})"
+                n += 1
+        used.add(unique_name.casefold())
+        unique_names.append(unique_name)
+    return unique_names
 
 # -------------------------------------------------------
 # Class that prepares pages and captures full-length shots
@@ -83,25 +184,37 @@ class PageCapturer:
     A helper class that:
     1. Navigates to a page and removes certain elements (e.g., sidebars).
     2. Displays dropdown (select) options as text.
-    3. Captures full-page screenshots by stitching multiple images.
+    3. Captures full-page screenshots in a single DevTools call, or by resizing
+       the viewport to the full page when that call is unavailable.
     """
 
-    def __init__(self, driver):
+    def __init__(self, driver, lossless=False):
         self.driver = driver
-        self.actual_screenshot_height = None
+        # JPEG encodes much faster than PNG in Chromium and img2pdf embeds it as is
+        if lossless:
+            self.screenshot_format = {"format": "png"}
+        else:
+            self.screenshot_format = {"format": "jpeg", "quality": JPEG_QUALITY}
 
     def prepare_page(self, url):
         """
-        Opens the given URL and removes certain UI elements (e.g., sidebars, badges).
+        Opens the given URL, waits for the CRF fields to render, and hides certain
+        UI elements (e.g., sidebars, badges) with a stylesheet rule, so elements
+        injected after the page loads (like Pendo badges) stay hidden too.
         Also converts <select> dropdowns into text for easier reference in screenshots.
         """
         self.driver.get(url)
-        time.sleep(3)
-        self.driver.execute_script("""
-            ['.mcc-sidebar-left', '._pendo-image', '._pendo-badge', '.sticky-bottom']
-            .forEach(selector => document.querySelector(selector)?.remove());
-        """)
+        try:
+            WebDriverWait(self.driver, CRF_READY_TIMEOUT).until(
+                EC.presence_of_element_located((By.CSS_SELECTOR, CRF_READY_SELECTOR))
+            )
+        except TimeoutException:
+            print(f"No CRF fields found on {url}; capturing the page as loaded.")
         self.driver.execute_script("""
+            const style = document.createElement('style');
+            style.textContent = arguments[0].join(', ') + ' { display: none !important; }';
+            document.head.appendChild(style);
+
             document.querySelectorAll('select').forEach(select => {
                 const options = Array.from(select.options)
                     .map(opt => opt.text.trim())
@@ -111,9 +224,7 @@ class PageCapturer:
                 span.textContent = 'Options: ' + options.join(' | ');
                 select.parentNode.insertBefore(span, select.nextSibling);
             });
-        """)
-        time.sleep(1)
-        self.driver.execute_script("document.documentElement.style.overflow = 'hidden';")
+        """, HIDDEN_SELECTORS)
 
     def get_page_dimensions(self):
         """
@@ -128,145 +239,370 @@ class PageCapturer:
             ];
         """)
 
-    def capture_full_page(self, crf_name, output_dir):
+    def capture_full_page(self):
         """
-        Scrolls through the web page in increments of the browser window height,
-        captures screenshots, and stitches them into one tall image.
-        Returns the final stitched PIL Image object.
+        Captures the entire document in a single Chrome DevTools Protocol
+        screenshot (captureBeyondViewport), so no scrolling or stitching is needed.
+        Falls back to resizing the viewport to the full page if the browser rejects
+        that call (e.g., an older Chrome without captureBeyondViewport).
+        Returns the encoded image (JPEG, or PNG when lossless) as bytes.
         """
         full_width, full_height = self.get_page_dimensions()
-
-        # Determine screenshot height if not already known
-        if not self.actual_screenshot_height:
-            test_path = os.path.join(output_dir, "test_screenshot.png")
-            self.driver.save_screenshot(test_path)
-            with Image.open(test_path) as img:
-                self.actual_screenshot_height = img.height
-            os.remove(test_path)
-
-        num_full_scrolls = full_height // self.actual_screenshot_height
-        remaining_height = full_height % self.actual_screenshot_height
-        screenshots = []
-
         try:
-            # Capture full scrolls
-            for i in range(num_full_scrolls):
-                self.driver.execute_script(f"window.scrollTo(0, {i * self.actual_screenshot_height})")
-                time.sleep(0.5)
-                temp_path = os.path.join(output_dir, f"temp_{crf_name}_{i}.png")
-                self.driver.save_screenshot(temp_path)
-                screenshots.append(temp_path)
-
-            # Capture the leftover part
-            if remaining_height > 0:
-                self.driver.execute_script(f"window.scrollTo(0, {full_height - self.actual_screenshot_height})")
-                time.sleep(0.5)
-                final_path = os.path.join(output_dir, f"temp_{crf_name}_final.png")
-                self.driver.save_screenshot(final_path)
-                with Image.open(final_path) as img:
-                    crop_y = img.height - remaining_height
-                    cropped = img.crop((0, crop_y, img.width, img.height))
-                    cropped.save(final_path)
-                screenshots.append(final_path)
-
-            # Stitch screenshots together
-            if screenshots:
-                final_image = Image.new('RGB', (full_width, full_height))
-                y_offset = 0
-                for idx, path in enumerate(screenshots):
-                    with Image.open(path) as img:
-                        if idx == len(screenshots) - 1 and remaining_height > 0:
-                            img = img.crop((0, img.height - remaining_height, img.width, img.height))
-                        paste_height = min(img.height, full_height - y_offset)
-                        final_image.paste(img, (0, y_offset))
-                        y_offset += paste_height
-                        if y_offset >= full_height:
-                            break
-                return final_image.crop((0, 0, full_width, full_height))
+            result = self.driver.execute_cdp_cmd("Page.captureScreenshot", {
+                **self.screenshot_format,
+                "captureBeyondViewport": True,
+                "optimizeForSpeed": True,
+                "clip": {"x": 0, "y": 0, "width": full_width, "height": full_height, "scale": 1},
+            })
+        except WebDriverException as e:
+            # Timeouts and a lost browser are not CDP errors; resizing would fail as well
+            if isinstance(e, TimeoutException) or is_session_lost(e):
+                raise
+            print(f"Full-page capture failed ({str(e).strip()}); retrying with a resized viewport.")
+            return self.capture_resized_viewport(full_width, full_height)
+        return base64.b64decode(result["data"])
+
+    def capture_resized_viewport(self, full_width, full_height):
+        """
+        Temporarily resizes the viewport to the full page dimensions, takes one
+        regular screenshot, then restores the original viewport.
+        Returns the encoded image (JPEG, or PNG when lossless) as bytes.
+        """
+        self.driver.execute_cdp_cmd("Emulation.setDeviceMetricsOverride", {
+            "width": full_width,
+            "height": full_height,
+            "deviceScaleFactor": 0,  # Keep the browser's own scale factor
+            "mobile": False,
+        })
+        try:
+            # Let the page repaint at the new size before capturing
+            self.driver.execute_async_script(
+                "requestAnimationFrame(() => requestAnimationFrame(arguments[0]));"
+            )
+            result = self.driver.execute_cdp_cmd("Page.captureScreenshot", self.screenshot_format)
+            return base64.b64decode(result["data"])
         finally:
-            # Clean up temp images
-            for path in screenshots:
-                if os.path.exists(path):
-                    os.remove(path)
+            self.driver.execute_cdp_cmd("Emulation.clearDeviceMetricsOverride", {})
 
+# -------------------------------------------
+# Builds the Chrome options used by every worker
+# -------------------------------------------
+def build_chrome_options(user_data_dir, headless=True, high_fidelity=False):
+    """
+    Returns Chrome options for a capture browser using the given profile.
+    Headless mode and the throttling flags cut rendering and screenshot latency;
+    headless=False gives a visible window for manual login steps such as 2FA.
+    Unless high_fidelity is set, pages render at a reduced scale factor and
+    page images are not loaded, which shrinks every screenshot and PDF.
+    """
+    options = Options()
+    options.add_argument(f"user-data-dir={user_data_dir}")
+    options.add_argument("--window-size=1920,1080")
+    options.add_argument("--hide-scrollbars")
+    scale_factor = 1 if high_fidelity else FAST_SCALE_FACTOR
+    options.add_argument(f"--force-device-scale-factor={scale_factor}")
+    # Set explicitly both ways, since the preference is saved into the profile
+    options.add_experimental_option("prefs", {
+        "profile.managed_default_content_settings.images": 1 if high_fidelity else 2,
+    })
+    if headless:
+        options.add_argument("--headless=new")
+    options.add_argument("--disable-gpu-vsync")
+    options.add_argument("--disable-background-timer-throttling")
+    options.add_argument("--disable-renderer-backgrounding")
+    options.add_argument("--disable-features=TranslateUI")
+    options.add_argument("--disable-dev-shm-usage")
+    return options
+
+# ------------------------------------------------
+# Launches a logged-in Chrome instance on a profile
+# ------------------------------------------------
+def start_logged_in_driver(user_data_dir, high_fidelity=False, check_session=True):
+    """
+    Starts a headless Chrome instance on the given profile and checks it for a valid
+    iMedidata session. If there is none, Chrome is relaunched with a visible window
+    and the login (including any 2FA step) happens there, once.
+    With check_session=False the headless check is skipped and the visible login
+    starts right away.
+    Returns the driver and whether an existing session was reused.
+    """
+    if check_session:
+        driver = webdriver.Chrome(options=build_chrome_options(user_data_dir, high_fidelity=high_fidelity))
+        if login(driver, interactive=False):
+            return driver, True
+        print("No saved session found. Opening a visible browser to log in.")
+        driver.quit()
+
+    driver = webdriver.Chrome(
+        options=build_chrome_options(user_data_dir, headless=False, high_fidelity=high_fidelity)
+    )
+    login(driver)
+    return driver, False
+
+# ----------------------------------------------------
+# Gives each worker its own copy of the master profile
+# ----------------------------------------------------
+def copy_worker_profile(master_dir, worker_id):
+    """
+    Refreshes a worker's Chrome profile from the logged-in master profile, so the
+    worker starts with the master's session cookies. Chrome will not open two
+    processes on the same user-data-dir, hence one copy per worker.
+    Caches and lock files are not copied.
+    Returns the worker's profile directory.
+    """
+    worker_dir = os.path.join(os.path.dirname(__file__), f'chromeprofile_{worker_id}')
+    shutil.rmtree(worker_dir, ignore_errors=True)
+    shutil.copytree(master_dir, worker_dir, ignore=shutil.ignore_patterns('Singleton*', 'lockfile', '*Cache*'))
+    return worker_dir
+
+# ----------------------------------------------------
+# Tracks captured CRF PDFs so reruns can skip them
+# ----------------------------------------------------
+def load_index(output_dir):
+    """
+    Loads the capture index for the output directory, mapping each URL to the
+    PDF saved for it ({"pdf": filename, "mtime": ..., "size": ...}) and the
+    capture settings it was taken with.
+    Returns an empty dict if no index exists yet.
+    """
+    index_path = os.path.join(output_dir, INDEX_FILENAME)
+    if not os.path.exists(index_path):
+        return {}
+    with open(index_path) as f:
+        return json.load(f)
+
+def save_index(output_dir, index, sync=False):
+    """
+    Writes the capture index atomically (temp file, then rename).
+    With sync=True the data is also flushed to disk before the rename.
+    """
+    index_path = os.path.join(output_dir, INDEX_FILENAME)
+    tmp_path = index_path + '.tmp'
+    with open(tmp_path, "w") as f:
+        json.dump(index, f, indent=2)
+        if sync:
+            f.flush()
+            os.fsync(f.fileno())
+    os.replace(tmp_path, index_path)
+
+def cached_pdf_path(output_dir, entry, capture_settings):
+    """
+    Returns the saved PDF path for an index entry if the file is still the one
+    that was recorded (non-empty, same size and modification time) and was
+    captured with the same settings as this run, else None.
+    """
+    if not entry:
+        return None
+    if any(entry.get(key) != value for key, value in capture_settings.items()):
+        return None
+    pdf_path = os.path.join(output_dir, entry['pdf'])
+    try:
+        stat = os.stat(pdf_path)
+    except OSError:
         return None
+    if stat.st_size > 0 and stat.st_size == entry['size'] and stat.st_mtime == entry['mtime']:
+        return pdf_path
+    return None
+
+# ------------------------------------------------
+# Recognizes errors from a browser that has died
+# ------------------------------------------------
+def is_session_lost(error):
+    """
+    Returns True if the error means the driver's browser session is gone
+    (crashed or closed Chrome), so the driver can't be used for further rows.
+    """
+    if isinstance(error, (InvalidSessionIdException, NoSuchWindowException)):
+        return True
+    return isinstance(error, WebDriverException) and any(
+        message in str(error) for message in ("chrome not reachable", "disconnected")
+    )
+
+# ---------------------------------------------
+# Captures a single CRF row and saves it as PDF
+# ---------------------------------------------
+def process_row(driver, crf_name, url, output_dir, lossless=False):
+    """
+    Captures the CRF page for one spreadsheet row and saves it as a PDF.
+    The PDF is written to a temp file and renamed into place, so an interrupted
+    run never leaves a partial PDF behind.
+    Returns the PDF path, or None if the capture failed. Errors that mean the
+    browser itself is gone (see is_session_lost) are raised to the caller instead.
+    """
+    pdf_path = os.path.join(output_dir, f'{crf_name}.pdf')
+    try:
+        print(f"Processing: {crf_name}")
+        capturer = PageCapturer(driver, lossless)
+        capturer.prepare_page(url)
+        image_bytes = capturer.capture_full_page()
+        if image_bytes:
+            tmp_path = pdf_path + '.tmp'
+            with open(tmp_path, "wb") as f:
+                f.write(img2pdf.convert(image_bytes))
+            os.replace(tmp_path, pdf_path)
+            print(f"Created: {pdf_path}")
+            return pdf_path
+        print(f"Failed to capture: {crf_name}")
+    except Exception as e:
+        if is_session_lost(e):
+            raise
+        print(f"Error processing {crf_name}: {str(e)}")
+    return None
+
+# ------------------------------
+# Parses command-line options
+# ------------------------------
+def parse_args():
+    """
+    Returns the parsed command-line options.
+    """
+    parser = argparse.ArgumentParser(description="Captures Rave EDC CRFs into a merged PDF casebook.")
+    parser.add_argument("--high-fidelity", action="store_true",
+                        help="capture at full scale with page images loaded (slower, larger PDFs)")
+    parser.add_argument("--lossless", action="store_true",
+                        help="capture screenshots as PNG instead of JPEG (slower, larger PDFs)")
+    return parser.parse_args()
 
 # -----------------------------------------------
 # Main function that reads URLs, captures pages,
-# converts them to PDFs, merges PDFs, and cleans up
+# converts them to PDFs, and merges the PDFs
 # -----------------------------------------------
 def main():
     """
     Main execution flow:
-    1. Installs/updates ChromeDriver automatically.
-    2. Creates a Chrome profile, logs into iMedidata.
-    3. Reads a list of URLs from an Excel file, then captures each page to PNG.
-    4. Converts PNG files to individual PDFs.
-    5. Merges all PDFs into one combined PDF.
-    6. Cleans up individual PDFs and finishes.
+    1. Parses command-line options and installs/updates ChromeDriver automatically.
+    2. Reads a list of URLs from an Excel file and skips those already captured
+       today, according to the index in the output directory.
+    3. Logs into iMedidata once on the master Chrome profile (reusing a saved session if valid).
+    4. Starts up to MAX_WORKERS browsers, each on its own copy of the master profile,
+       and captures the remaining pages in parallel (workers that fail to start are skipped).
+    5. Saves each capture as an individual PDF and records it in the index.
+    6. Merges all PDFs into one combined PDF, in spreadsheet order, bookmarked by CRF name.
     """
+    args = parse_args()
     chromedriver_autoinstaller.install()
 
-    options = Options()
-    user_data_dir = os.path.join(os.path.dirname(__file__), 'chromeprofile')
-    options.add_argument(f"user-data-dir={user_data_dir}")
-    options.add_argument("--window-size=1920,1080")
-    options.add_argument("--hide-scrollbars")
-    options.add_argument("--force-device-scale-factor=1")
-
-    driver = webdriver.Chrome(options=options)
-    login(driver)  # Call the login function right after credentials
-
     today = datetime.datetime.now().strftime("%d%b%Y")
     output_dir = f"output_{today}"
     os.makedirs(output_dir, exist_ok=True)
 
     df = pd.read_excel('URLs.xlsx')
-    pdf_files = []
-    capturer = PageCapturer(driver)
-
-    for _, row in df.iterrows():
-        crf_name = sanitize_filename(row['CRF'])
-        url = row['URL']
-        png_path = os.path.join(output_dir, f'{crf_name}.png')
-        pdf_path = os.path.join(output_dir, f'{crf_name}.pdf')
-
-        if os.path.exists(pdf_path):
-            pdf_files.append(pdf_path)
-            continue
-
+    crf_names = make_unique_names([sanitize_filename(name) for name in df['CRF']])
+    urls = df['URL'].to_numpy()
+    index = load_index(output_dir)
+    # Settings that change what gets captured; saved PDFs are reused only if they match
+    capture_settings = {
+        "high_fidelity": args.high_fidelity,
+        "format": "png" if args.lossless else "jpeg",
+    }
+    pdf_files = [None] * len(crf_names)
+
+    to_capture = []
+    for i, (crf_name, url) in enumerate(zip(crf_names, urls)):
+        pdf_path = cached_pdf_path(output_dir, index.get(url), capture_settings)
+        if pdf_path:
+            print(f"Already captured: {crf_name}")
+            pdf_files[i] = pdf_path
+        else:
+            to_capture.append((i, crf_name, url))
+
+    if to_capture:
+        # Log in once on the master profile; workers start from copies of it
+        master_dir = os.path.join(os.path.dirname(__file__), 'chromeprofile')
+        master_driver, _ = start_logged_in_driver(master_dir, args.high_fidelity)
+        master_driver.quit()
+
+        # Start the workers' browsers up front; a worker that fails to start is
+        # left out of the pool instead of failing the rows it would have taken
+        # Session cookies without an expiry don't survive the master browser quitting;
+        # if the first worker's copy has no session, the rest log in visibly right away
+        drivers = []
+        session_copied = True
         try:
-            print(f"Processing: {crf_name}")
-            capturer.prepare_page(url)
-            stitched = capturer.capture_full_page(crf_name, output_dir)
-            if stitched:
-                stitched.save(png_path)
-                with open(pdf_path, "wb") as f:
-                    f.write(img2pdf.convert(png_path))
-                pdf_files.append(pdf_path)
-                print(f"Created: {pdf_path}")
+            for worker_id in range(min(MAX_WORKERS, len(to_capture))):
+                try:
+                    worker_profile = copy_worker_profile(master_dir, worker_id)
+                    driver, session_copied = start_logged_in_driver(
+                        worker_profile, args.high_fidelity, check_session=session_copied
+                    )
+                    drivers.append(driver)
+                except Exception as e:
+                    print(f"Error starting worker {worker_id}: {str(e)}")
+
+            if not drivers:
+                print("No browser could be started; skipping capture.")
             else:
-                print(f"Failed to capture: {crf_name}")
-        except Exception as e:
-            print(f"Error processing {crf_name}: {str(e)}")
-            continue
-
-    if pdf_files:
-        merger = PdfMerger()
-        for pdf in pdf_files:
-            bookmark_name = os.path.splitext(os.path.basename(pdf))[0]  # Extract filename without extension for bookmark
-            merger.append(pdf, outline_item=bookmark_name)
+                # Rows check a browser out of the pool and return it when done.
+                # A browser whose session is lost is dropped instead, since it would
+                # fail every row it picks up; once all are gone, None is queued so
+                # the remaining rows stop waiting.
+                idle_drivers = queue.Queue()
+                for driver in drivers:
+                    idle_drivers.put(driver)
+                lost_drivers = []
+
+                def run_row(crf_name, url):
+                    driver = idle_drivers.get()
+                    if driver is None:
+                        idle_drivers.put(None)
+                        print(f"Skipping {crf_name}: no browser left")
+                        return None
+                    try:
+                        pdf_path = process_row(driver, crf_name, url, output_dir, args.lossless)
+                    except Exception as e:
+                        print(f"Browser lost while processing {crf_name}, removing it from the pool: {str(e)}")
+                        lost_drivers.append(driver)
+                        if len(lost_drivers) == len(drivers):
+                            idle_drivers.put(None)
+                        return None
+                    idle_drivers.put(driver)
+                    return pdf_path
+
+                with ThreadPoolExecutor(max_workers=len(drivers)) as executor:
+                    pending = {executor.submit(run_row, crf_name, url): (i, crf_name, url)
+                               for i, crf_name, url in to_capture}
+                    for future in as_completed(pending):
+                        i, crf_name, url = pending[future]
+                        try:
+                            pdf_path = future.result()
+                            if pdf_path:
+                                stat = os.stat(pdf_path)
+                                index[url] = {
+                                    "pdf": os.path.basename(pdf_path),
+                                    "mtime": stat.st_mtime,
+                                    "size": stat.st_size,
+                                    **capture_settings,
+                                }
+                                save_index(output_dir, index)
+                                pdf_files[i] = pdf_path
+                        except Exception as e:
+                            print(f"Error processing {crf_name}: {str(e)}")
+        finally:
+            for driver in drivers:
+                try:
+                    driver.quit()
+                except Exception:
+                    pass  # The browser may already be gone
+            save_index(output_dir, index, sync=True)
+
+    captured = [(crf_name, pdf) for crf_name, pdf in zip(crf_names, pdf_files) if pdf]
+    if captured:
         merged_pdf_path = os.path.join(output_dir, "Rave EDC - CRF Casebook.pdf")
-        merger.write(merged_pdf_path)
-        merger.close()
+        # Source PDFs must stay open until the merged file is saved
+        sources = [pikepdf.open(pdf) for _, pdf in captured]
+        try:
+            with pikepdf.Pdf.new() as merged:
+                with merged.open_outline() as outline:
+                    for (crf_name, _), src in zip(captured, sources):
+                        outline.root.append(pikepdf.OutlineItem(crf_name, len(merged.pages)))
+                        merged.pages.extend(src.pages)
+                merged.save(merged_pdf_path)
+        finally:
+            for src in sources:
+                src.close()
         print(f"Merged PDF created successfully at {merged_pdf_path}")
 
-    # Cleanup individual PDFs (optional)
-    for pdf in pdf_files:
-        if os.path.exists(pdf):
-            os.remove(pdf)
-
-    driver.quit()
     print("Process completed successfully!")
 
 if __name__ == "__main__":